@@ -10,14 +10,19 @@ RegGraph [レグラフ]
 機能:
 - 広告費 vs 新規UU グラフ
 - 広告費 vs N-CPA グラフ（N-CPA = 広告費 ÷ 新規UU）
+- 2つのグラフは上下2段の1つのFigureとして表示（X軸のズーム・パン、凡例の表示切替は連動）
 """
 
 import streamlit as st
 import pandas as pd
 import numpy as np
 import plotly.graph_objects as go
+from plotly.subplots import make_subplots
+from plotly.offline import get_plotlyjs_version
 import re
 import io
+import math
+from concurrent.futures import ThreadPoolExecutor
 
 st.set_page_config(
     page_title="RegGraph [レグラフ]",
@@ -26,14 +31,127 @@ st.set_page_config(
 )
 
 # セッション状態の初期化（ダウンロード後も状態を保持するため）
-if 'fig_uu' not in st.session_state:
-    st.session_state.fig_uu = None
-if 'fig_ncpa' not in st.session_state:
-    st.session_state.fig_ncpa = None
-if 'graph_generated' not in st.session_state:
-    st.session_state.graph_generated = False
-if 'brand_count' not in st.session_state:
-    st.session_state.brand_count = 0
+# グラフ本体はキャッシュに載っているので、最後に生成したときの引数だけを保持する
+if 'graph_args' not in st.session_state:
+    st.session_state.graph_args = None
+# ダウンロード用HTML（to_htmlは重いので再実行ごとに作り直さない。plotly.jsの埋め込み方式ごとに保持）
+if 'html' not in st.session_state:
+    st.session_state.html = {}
+# 軽量ダウンロード用のグラフJSON
+if 'json' not in st.session_state:
+    st.session_state.json = None
+
+# 回帰式パース用の正規表現（Series.str.extract で列ごとに一括適用）
+_LOG_RE = re.compile(r'y\s*=\s*([-\d.]+)\s*\*\s*ln\(x\)\s*\+\s*([-\d.]+)')
+_LIN_RE = re.compile(r'y\s*=\s*([-\d.]+)\s*\*\s*x\s*\+\s*([-\d.]+)')
+
+# 入力データのカラム（読み込み時に型を指定して型推論を省く。これ以外のカラムは読み込まない）
+# 数値カラムもいったん文字列で読む（#DIV/0! などのセルが1つあるだけで全体が読めなくならないように）
+_NUMERIC_COLS = ['決定係数(対数)', 'データ範囲 min x', 'データ範囲 max x', '決定係数(線形)']
+_USECOLS = [
+    '出品者カテゴリー',
+    '広告費と広告新規UUの対数回帰式',
+    '決定係数(対数)',
+    'データ範囲 min x',
+    'データ範囲 max x',
+    '広告費と広告新規UUの線形回帰式',
+    '決定係数(線形)',
+]
+_DTYPES = dict.fromkeys(_USECOLS, 'string')
+
+# グラフJSONを表示するビューア（plotly.jsはCDNから読み込み、選択したJSONファイルを描画）
+_JSON_VIEWER_HTML = """<!DOCTYPE html>
+<html lang="ja">
+<head>
+<meta charset="utf-8">
+<title>RegGraph Viewer</title>
+<script src="https://cdn.plot.ly/plotly-__PLOTLYJS_VERSION__.min.js"></script>
+</head>
+<body>
+<input type="file" id="file" accept=".json,application/json">
+<div id="graph" style="width:100%;height:90vh;"></div>
+<script>
+document.getElementById('file').addEventListener('change', function (e) {
+    var reader = new FileReader();
+    reader.onload = function () {
+        var fig = JSON.parse(reader.result);
+        Plotly.newPlot('graph', fig.data, fig.layout, {responsive: true});
+    };
+    reader.readAsText(e.target.files[0]);
+});
+</script>
+</body>
+</html>
+""".replace('__PLOTLYJS_VERSION__', get_plotlyjs_version())
+
+# 曲線のサンプル点数（滑らかな曲線なのでこの程度で見た目は変わらない）
+_N_MAIN = 150  # データ範囲内
+_N_EXT = 60    # 外挿範囲
+_MIN_EXT_FRACTION = 0.01  # X軸全体に対してこれより短い外挿範囲は描かない
+
+# 曲線（ブランド数 × 表示する回帰式の数）がこれを超えたらWebGL描画（Scattergl）に切り替える
+# SVGは本数に比例して重くなる。少数ならWebGLの初期化コストの方が大きいのでSVGのまま
+_WEBGL_CURVE_THRESHOLD = 20
+
+# グラフ種類ごとに表示する回帰式と、回帰式ごとの表示名・決定係数のカラム
+_GRAPH_FITS = {
+    "対数回帰（サチュレーションあり）": ('log',),
+    "線形回帰（サチュレーションなし）": ('lin',),
+    "両方表示": ('log', 'lin'),
+}
+_FITS = {
+    'log': ("対数", '決定係数(対数)'),
+    'lin': ("線形", '決定係数(線形)'),
+}
+
+# カラーパレット
+_PALETTE = [
+    '#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd',
+    '#8c564b', '#e377c2', '#7f7f7f', '#bcbd22', '#17becf',
+    '#aec7e8', '#ffbb78', '#98df8a', '#ff9896', '#c5b0d5'
+]
+
+# レイアウト設定（タイトル以外）
+_LAYOUT = dict(
+    height=900,
+    hovermode='closest',
+    legend=dict(
+        yanchor="top",
+        y=0.99,
+        xanchor="left",
+        x=1.02,
+        font=dict(size=10)
+    ),
+    margin=dict(r=250),
+    template='plotly_white'
+)
+
+# 上段（新規UU）・下段（N-CPA）の見出し
+_SUBPLOT_TITLES = ("広告費 vs 新規UU", "広告費 vs N-CPA（N-CPA = 広告費 ÷ 新規UU）")
+
+# 軸のフォーマット（0以上のみ表示。X軸は上下段で共有し、タイトルは下段のみ）
+_XAXIS_TITLE = "月間SA広告費 (円)"
+_XAXIS_OPTS = dict(
+    tickformat=",",
+    gridcolor='lightgray',
+    gridwidth=0.5,
+    rangemode='tozero'
+)
+_UU_YAXIS_OPTS = dict(
+    title_text="広告新規UU数",
+    tickformat=",",
+    gridcolor='lightgray',
+    gridwidth=0.5,
+    rangemode='nonnegative',
+    range=[0, None]
+)
+_NCPA_YAXIS_OPTS = dict(
+    title_text="N-CPA (円/UU)",
+    tickformat=",",
+    gridcolor='lightgray',
+    gridwidth=0.5,
+    rangemode='tozero'
+)
 
 st.title("📈 RegGraph [レグラフ]")
 st.markdown("統計サマリの表データからインタラクティブな回帰曲線グラフを生成します")
@@ -91,412 +209,365 @@ with st.expander("⚙️ Advanced Settings", expanded=False):
     graph_title = st.text_input("グラフタイトル", value="ブランド別 SA広告費のサチュレーション")
 
 
-def parse_log_equation(eq_str):
-    """対数回帰式をパース: y = a * ln(x) + b"""
-    match = re.search(r'y\s*=\s*([-\d.]+)\s*\*\s*ln\(x\)\s*\+\s*([-\d.]+)', eq_str)
-    if match:
-        return float(match.group(1)), float(match.group(2))
-    return None, None
+def _trace_type(df, graph_type):
+    """
+    曲線の本数に応じてトレースの型を選ぶ
+    Scattergl でも線種・透明度・ホバー表示（hovertemplate）は Scatter と同じように使える
+    """
+    n_curves = len(df) * (2 if graph_type == "両方表示" else 1)
+    return go.Scattergl if n_curves > _WEBGL_CURVE_THRESHOLD else go.Scatter
+
+
+def _emit_curve(traces, x, y, color, name, legend_group, hover, line_style=None, extrapolated=False,
+                showlegend=True, trace_type=go.Scatter):
+    """曲線トレースを traces に追加（extrapolated=True なら外挿用の半透明な破線・凡例なし）"""
+    if extrapolated:
+        line = dict(color=color, width=1.5, dash='dash')
+    else:
+        line = dict(color=color, width=2, dash=line_style)
+
+    traces.append(trace_type(
+        x=x, y=y,
+        mode='lines',
+        name=name,
+        line=line,
+        opacity=0.5 if extrapolated else None,
+        legendgroup=legend_group,
+        showlegend=False if extrapolated or not showlegend else None,
+        hovertemplate=hover
+    ))
+
+
+def _positive_range(x_grid, a, b, log):
+    """
+    新規UU（a * ln(x) + b または a * x + b）が正になる区間を x_grid 上のスライスで返す
+    UU = 0 となる点 x_zero を解析的に求め、a の符号で x_zero より右側か左側かを選ぶ
+    """
+    if pd.isna(a) or a == 0:
+        return slice(None) if b > 0 else slice(0, 0)
+    a, b = float(a), float(b)  # float32の係数だと -b / a 自体が桁あふれすることがあるのでfloat64で計算
+    # 指数は exp が桁あふれしないよう打ち切る（打ち切るほど大きければ x_grid のどの点よりも右）
+    x_zero = math.exp(min(-b / a, 700.0)) if log else -b / a
+    if a > 0:
+        return slice(np.searchsorted(x_grid, x_zero, side='right'), None)
+    return slice(0, np.searchsorted(x_grid, x_zero, side='left'))
 
 
-def parse_linear_equation(eq_str):
-    """線形回帰式をパース: y = a * x + b"""
-    match = re.search(r'y\s*=\s*([-\d.]+)\s*\*\s*x\s*\+\s*([-\d.]+)', eq_str)
-    if match:
-        return float(match.group(1)), float(match.group(2))
-    return None, None
+def _precompute_curves(a_log, b_log, a_lin, b_lin, x_grid):
+    """
+    1つのX軸グリッド上で新規UU・N-CPAを対数/線形まとめて計算
+    N-CPAはUUが正の区間のみ（x_ncpa_log / x_ncpa_lin がそのX座標）
+    """
+    uu_log = a_log * np.log(x_grid) + b_log
+    uu_lin = a_lin * x_grid + b_lin
+    pos_log = _positive_range(x_grid, a_log, b_log, log=True)
+    pos_lin = _positive_range(x_grid, a_lin, b_lin, log=False)
+    return {
+        'x': x_grid,
+        'uu_log': uu_log,
+        'uu_lin': uu_lin,
+        'x_ncpa_log': x_grid[pos_log],
+        'ncpa_log': x_grid[pos_log] / uu_log[pos_log],
+        'x_ncpa_lin': x_grid[pos_lin],
+        'ncpa_lin': x_grid[pos_lin] / uu_lin[pos_lin],
+    }
+
+
+def build_brand_curves(df, show_extrapolation, extrap_ratio=1.5):
+    """
+    ブランドごとの曲線データを事前計算
+    main: データ範囲内、left/right: 外挿範囲（外挿なし・範囲が見えないほど短い場合はNone）
+    """
+    # 全体のX範囲を取得（外挿用に拡張）
+    all_x_min = df['データ範囲 min x'].min()
+    all_x_max = df['データ範囲 max x'].max() * extrap_ratio  # 拡張倍率を適用
 
+    # これより短い外挿範囲はグラフ上で見えないので作らない
+    min_ext = _MIN_EXT_FRACTION * (all_x_max - all_x_min)
+
+    # 描画用の曲線なのでサンプル点と係数はfloat32で持つ（計算量を抑え、Plotly 6以降は配列をバイナリで書き出すので配列部分のサイズも半分になる）
+    # X範囲は外挿範囲の有無の判定に使うのでfloat64のまま
+    ranges = df[['データ範囲 min x', 'データ範囲 max x']].to_numpy()
+    coefs = df[['a_log', 'b_log', 'a_lin', 'b_lin']].to_numpy(dtype=np.float32)
+
+    curves = []
+    for (x_min, x_max), (a_log, b_log, a_lin, b_lin) in zip(ranges, coefs):
+        grids = {
+            'main': np.linspace(x_min, x_max, _N_MAIN, dtype=np.float32),
+            'left': (np.linspace(all_x_min, x_min, _N_EXT, dtype=np.float32)
+                     if show_extrapolation and x_min - all_x_min > min_ext else None),
+            'right': (np.linspace(x_max, all_x_max, _N_EXT, dtype=np.float32)
+                      if show_extrapolation and all_x_max - x_max > min_ext else None),
+        }
+        curves.append({
+            key: _precompute_curves(a_log, b_log, a_lin, b_lin, x_grid) if x_grid is not None else None
+            for key, x_grid in grids.items()
+        })
+    return curves
+
+
+def _brand_strings(df, hover_y):
+    """ブランドごとのホバー表示（データ範囲内・外挿）と外挿トレース名のリストを返す"""
+    brands = df['出品者カテゴリー'].to_numpy()
+    hover_main = [f"<b>{brand}</b><br>{hover_y}" for brand in brands]
+    hover_ext = [f"<b>{brand} (外挿)</b><br>{hover_y}" for brand in brands]
+    ext_names = [f"{brand} (外挿)" for brand in brands]
+    return hover_main, hover_ext, ext_names
+
+
+def _fit_rows(df, fit, graph_type):
+    """
+    回帰式（fit は 'log' / 'lin'）をパースできたブランドごとに (行番号, 色, 凡例名, 凡例グループ) を返す
+    凡例グループはブランド × 回帰式ごとで、新規UU・N-CPAの両グラフで共通
+    """
+    fit_name, r2_col = _FITS[fit]
+    df_fit = df.dropna(subset=[f'a_{fit}', f'b_{fit}'])
+    for i, brand, r2 in zip(df_fit.index, df_fit['出品者カテゴリー'].to_numpy(), df_fit[r2_col].to_numpy()):
+        label = f"{brand} (R²={r2:.3f})" if graph_type != "両方表示" else f"{brand} {fit_name} (R²={r2:.3f})"
+        yield i, _PALETTE[i % len(_PALETTE)], label, f"{brand}_{fit}"
 
-def generate_graph(df, graph_type, show_extrapolation, title, extrap_ratio=1.5):
-    """Plotlyグラフを生成"""
-    fig = go.Figure()
 
-    # カラーパレット
-    colors = [
-        '#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd',
-        '#8c564b', '#e377c2', '#7f7f7f', '#bcbd22', '#17becf',
-        '#aec7e8', '#ffbb78', '#98df8a', '#ff9896', '#c5b0d5'
-    ]
+def build_uu_traces(df, curves, graph_type):
+    """新規UUグラフのトレースを生成（曲線データは build_brand_curves で計算済みのものを使う）"""
+    trace_type = _trace_type(df, graph_type)
+    hover_y = "広告費: %{x:,.0f}円<br>新規UU: %{y:,.0f}<extra></extra>"
+    hover_main, hover_ext, ext_names = _brand_strings(df, hover_y)
 
-    # 全体のX範囲を取得（外挿用に拡張）
-    all_x_min = df['データ範囲 min x'].min()
-    all_x_max = df['データ範囲 max x'].max() * extrap_ratio  # 拡張倍率を適用
+    # 凡例をブランド順に並べるため、トレースはブランドごとに集めてから追加
+    # （df のインデックスは 0 からの行番号なので curves / brand_traces の添字にそのまま使える）
+    brand_traces = [[] for _ in range(len(df))]
 
-    for i, (_, row) in enumerate(df.iterrows()):
-        brand = row['出品者カテゴリー']
-        x_min = row['データ範囲 min x']
-        x_max = row['データ範囲 max x']
-        color = colors[i % len(colors)]
-
-        # 対数回帰
-        if graph_type in ["対数回帰（サチュレーションあり）", "両方表示"]:
-            a_log, b_log = parse_log_equation(row['広告費と広告新規UUの対数回帰式'])
-            r2_log = row['決定係数(対数)']
-
-            if a_log is not None:
-                # データ範囲内（実線）
-                x_data = np.linspace(x_min, x_max, 300)
-                y_data = a_log * np.log(x_data) + b_log
-
-                label = f"{brand} (R²={r2_log:.3f})" if graph_type != "両方表示" else f"{brand} 対数 (R²={r2_log:.3f})"
-                legend_group = f"{brand}_log"  # 凡例グループ名
-
-                fig.add_trace(go.Scatter(
-                    x=x_data, y=y_data,
-                    mode='lines',
-                    name=label,
-                    line=dict(color=color, width=2),
-                    legendgroup=legend_group,
-                    hovertemplate=f"<b>{brand}</b><br>広告費: %{{x:,.0f}}円<br>新規UU: %{{y:,.0f}}<extra></extra>"
-                ))
-
-                # 外挿範囲（点線）
-                if show_extrapolation:
-                    if all_x_min < x_min:
-                        x_ext_left = np.linspace(all_x_min, x_min, 100)
-                        y_ext_left = a_log * np.log(x_ext_left) + b_log
-                        fig.add_trace(go.Scatter(
-                            x=x_ext_left, y=y_ext_left,
-                            mode='lines',
-                            name=f"{brand} (外挿)",
-                            line=dict(color=color, width=1.5, dash='dash'),
-                            opacity=0.5,
-                            legendgroup=legend_group,
-                            showlegend=False,
-                            hovertemplate=f"<b>{brand} (外挿)</b><br>広告費: %{{x:,.0f}}円<br>新規UU: %{{y:,.0f}}<extra></extra>"
-                        ))
-
-                    if all_x_max > x_max:
-                        x_ext_right = np.linspace(x_max, all_x_max, 100)
-                        y_ext_right = a_log * np.log(x_ext_right) + b_log
-                        fig.add_trace(go.Scatter(
-                            x=x_ext_right, y=y_ext_right,
-                            mode='lines',
-                            name=f"{brand} (外挿)",
-                            line=dict(color=color, width=1.5, dash='dash'),
-                            opacity=0.5,
-                            legendgroup=legend_group,
-                            showlegend=False,
-                            hovertemplate=f"<b>{brand} (外挿)</b><br>広告費: %{{x:,.0f}}円<br>新規UU: %{{y:,.0f}}<extra></extra>"
-                        ))
-
-        # 線形回帰
-        if graph_type in ["線形回帰（サチュレーションなし）", "両方表示"]:
-            a_lin, b_lin = parse_linear_equation(row['広告費と広告新規UUの線形回帰式'])
-            r2_lin = row['決定係数(線形)']
-
-            if a_lin is not None:
-                x_data = np.linspace(x_min, x_max, 300)
-                y_data = a_lin * x_data + b_lin
-
-                label = f"{brand} (R²={r2_lin:.3f})" if graph_type != "両方表示" else f"{brand} 線形 (R²={r2_lin:.3f})"
-                line_style = 'dot' if graph_type == "両方表示" else 'solid'
-                legend_group = f"{brand}_lin"  # 凡例グループ名
-
-                fig.add_trace(go.Scatter(
-                    x=x_data, y=y_data,
-                    mode='lines',
-                    name=label,
-                    line=dict(color=color, width=2, dash=line_style),
-                    legendgroup=legend_group,
-                    hovertemplate=f"<b>{brand}</b><br>広告費: %{{x:,.0f}}円<br>新規UU: %{{y:,.0f}}<extra></extra>"
-                ))
-
-                # 外挿範囲（点線）
-                if show_extrapolation:
-                    if all_x_min < x_min:
-                        x_ext_left = np.linspace(all_x_min, x_min, 100)
-                        y_ext_left = a_lin * x_ext_left + b_lin
-                        fig.add_trace(go.Scatter(
-                            x=x_ext_left, y=y_ext_left,
-                            mode='lines',
-                            name=f"{brand} (外挿)",
-                            line=dict(color=color, width=1.5, dash='dash'),
-                            opacity=0.5,
-                            legendgroup=legend_group,
-                            showlegend=False,
-                            hovertemplate=f"<b>{brand} (外挿)</b><br>広告費: %{{x:,.0f}}円<br>新規UU: %{{y:,.0f}}<extra></extra>"
-                        ))
-
-                    if all_x_max > x_max:
-                        x_ext_right = np.linspace(x_max, all_x_max, 100)
-                        y_ext_right = a_lin * x_ext_right + b_lin
-                        fig.add_trace(go.Scatter(
-                            x=x_ext_right, y=y_ext_right,
-                            mode='lines',
-                            name=f"{brand} (外挿)",
-                            line=dict(color=color, width=1.5, dash='dash'),
-                            opacity=0.5,
-                            legendgroup=legend_group,
-                            showlegend=False,
-                            hovertemplate=f"<b>{brand} (外挿)</b><br>広告費: %{{x:,.0f}}円<br>新規UU: %{{y:,.0f}}<extra></extra>"
-                        ))
+    for fit in _GRAPH_FITS[graph_type]:
+        # 両方表示のときは線形を点線にして区別
+        line_style = 'dot' if fit == 'lin' and graph_type == "両方表示" else None
+        for i, color, label, legend_group in _fit_rows(df, fit, graph_type):
+            main, left, right = curves[i]['main'], curves[i]['left'], curves[i]['right']
+            traces = brand_traces[i]
 
-    # レイアウト設定
-    fig.update_layout(
-        title=dict(text=title, font=dict(size=20)),
-        xaxis_title="月間SA広告費 (円)",
-        yaxis_title="広告新規UU数",
-        hovermode='closest',
-        legend=dict(
-            yanchor="top",
-            y=0.99,
-            xanchor="left",
-            x=1.02,
-            font=dict(size=10)
-        ),
-        margin=dict(r=250),
-        template='plotly_white'
-    )
+            # データ範囲内（実線）
+            _emit_curve(traces, main['x'], main[f'uu_{fit}'], color,
+                        label, legend_group, hover_main[i], line_style=line_style, trace_type=trace_type)
 
-    # X軸のフォーマット（0以上のみ表示）
-    fig.update_xaxes(
-        tickformat=",",
-        gridcolor='lightgray',
-        gridwidth=0.5,
-        rangemode='tozero'
-    )
-    fig.update_yaxes(
-        tickformat=",",
-        gridcolor='lightgray',
-        gridwidth=0.5,
-        rangemode='nonnegative',
-        range=[0, None]
-    )
+            # 外挿範囲（点線）
+            for ext in (left, right):
+                if ext is not None:
+                    _emit_curve(traces, ext['x'], ext[f'uu_{fit}'], color,
+                                ext_names[i], legend_group, hover_ext[i], extrapolated=True, trace_type=trace_type)
 
-    return fig
+    return [trace for traces in brand_traces for trace in traces]
 
 
-def find_ncpa_minimum_log(a, b):
+def build_ncpa_traces(df, curves, graph_type):
     """
-    対数回帰のN-CPA最小点を求める
-    N-CPA = x / (a * ln(x) + b) の最小点
-    微分して0になる点: x = exp(1 - b/a)
+    N-CPAグラフのトレースを生成（N-CPA = 広告費 ÷ 新規UU）- 単調増加部分のみ表示
+    凡例は新規UUグラフと共有する（同じ凡例グループに入れ、N-CPA側は凡例に出さない）
     """
-    if a <= 0:
-        return None
-    x_min = np.exp(1 - b / a)
-    # 最小点でUUが正であることを確認
-    uu_at_min = a * np.log(x_min) + b
-    if uu_at_min > 0:
-        return x_min
-    return None
-
-
-def generate_ncpa_graph(df, graph_type, show_extrapolation, title, extrap_ratio=1.5):
-    """N-CPAグラフを生成（N-CPA = 広告費 ÷ 新規UU）- 単調増加部分のみ表示"""
-    fig = go.Figure()
-
-    # カラーパレット
-    colors = [
-        '#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd',
-        '#8c564b', '#e377c2', '#7f7f7f', '#bcbd22', '#17becf',
-        '#aec7e8', '#ffbb78', '#98df8a', '#ff9896', '#c5b0d5'
-    ]
-
-    # 全体のX範囲を取得（外挿用に拡張）
-    all_x_max = df['データ範囲 max x'].max() * extrap_ratio
-
-    for i, (_, row) in enumerate(df.iterrows()):
-        brand = row['出品者カテゴリー']
-        x_min = row['データ範囲 min x']
-        x_max = row['データ範囲 max x']
-        color = colors[i % len(colors)]
-
-        # 対数回帰からN-CPA算出（単調増加部分のみ）
-        if graph_type in ["対数回帰（サチュレーションあり）", "両方表示"]:
-            a_log, b_log = parse_log_equation(row['広告費と広告新規UUの対数回帰式'])
-            r2_log = row['決定係数(対数)']
-
-            if a_log is not None:
-                # N-CPAの最小点を求める
-                x_ncpa_min = find_ncpa_minimum_log(a_log, b_log)
-
-                # 表示開始点: N-CPA最小点とデータ範囲の大きい方
-                if x_ncpa_min is not None:
-                    x_start = max(x_ncpa_min, x_min)
-                else:
-                    x_start = x_min
-
-                # データ範囲内（実線）- 単調増加部分のみ
-                if x_start < x_max:
-                    x_data = np.linspace(x_start, x_max, 300)
-                    y_uu = a_log * np.log(x_data) + b_log
-                    y_ncpa = np.where(y_uu > 0, x_data / y_uu, np.nan)
-
-                    label = f"{brand} (R²={r2_log:.3f})" if graph_type != "両方表示" else f"{brand} 対数 (R²={r2_log:.3f})"
-                    legend_group = f"{brand}_ncpa_log"  # 凡例グループ名
-
-                    fig.add_trace(go.Scatter(
-                        x=x_data, y=y_ncpa,
-                        mode='lines',
-                        name=label,
-                        line=dict(color=color, width=2),
-                        legendgroup=legend_group,
-                        hovertemplate=f"<b>{brand}</b><br>広告費: %{{x:,.0f}}円<br>N-CPA: %{{y:,.0f}}円<extra></extra>"
-                    ))
-
-                    # 外挿範囲（点線）- 右側のみ（単調増加方向）
-                    if show_extrapolation and all_x_max > x_max:
-                        x_ext_right = np.linspace(x_max, all_x_max, 100)
-                        y_uu_right = a_log * np.log(x_ext_right) + b_log
-                        y_ncpa_right = np.where(y_uu_right > 0, x_ext_right / y_uu_right, np.nan)
-                        fig.add_trace(go.Scatter(
-                            x=x_ext_right, y=y_ncpa_right,
-                            mode='lines',
-                            name=f"{brand} (外挿)",
-                            line=dict(color=color, width=1.5, dash='dash'),
-                            opacity=0.5,
-                            legendgroup=legend_group,
-                            showlegend=False,
-                            hovertemplate=f"<b>{brand} (外挿)</b><br>広告費: %{{x:,.0f}}円<br>N-CPA: %{{y:,.0f}}円<extra></extra>"
-                        ))
-
-        # 線形回帰からN-CPA算出
-        # 線形の場合: N-CPA = x / (ax + b) は x→∞ で 1/a に収束（単調減少）
-        # 実務的には対数回帰のみが意味を持つが、参考として表示
-        if graph_type in ["線形回帰（サチュレーションなし）", "両方表示"]:
-            a_lin, b_lin = parse_linear_equation(row['広告費と広告新規UUの線形回帰式'])
-            r2_lin = row['決定係数(線形)']
-
-            if a_lin is not None:
-                x_data = np.linspace(x_min, x_max, 300)
-                y_uu = a_lin * x_data + b_lin
-                y_ncpa = np.where(y_uu > 0, x_data / y_uu, np.nan)
-
-                label = f"{brand} (R²={r2_lin:.3f})" if graph_type != "両方表示" else f"{brand} 線形 (R²={r2_lin:.3f})"
-                line_style = 'dot' if graph_type == "両方表示" else 'solid'
-                legend_group = f"{brand}_ncpa_lin"  # 凡例グループ名
-
-                fig.add_trace(go.Scatter(
-                    x=x_data, y=y_ncpa,
-                    mode='lines',
-                    name=label,
-                    line=dict(color=color, width=2, dash=line_style),
-                    legendgroup=legend_group,
-                    hovertemplate=f"<b>{brand}</b><br>広告費: %{{x:,.0f}}円<br>N-CPA: %{{y:,.0f}}円<extra></extra>"
-                ))
-
-                # 外挿範囲（点線）- 右側のみ
-                if show_extrapolation and all_x_max > x_max:
-                    x_ext_right = np.linspace(x_max, all_x_max, 100)
-                    y_uu_right = a_lin * x_ext_right + b_lin
-                    y_ncpa_right = np.where(y_uu_right > 0, x_ext_right / y_uu_right, np.nan)
-                    fig.add_trace(go.Scatter(
-                        x=x_ext_right, y=y_ncpa_right,
-                        mode='lines',
-                        name=f"{brand} (外挿)",
-                        line=dict(color=color, width=1.5, dash='dash'),
-                        opacity=0.5,
-                        legendgroup=legend_group,
-                        showlegend=False,
-                        hovertemplate=f"<b>{brand} (外挿)</b><br>広告費: %{{x:,.0f}}円<br>N-CPA: %{{y:,.0f}}円<extra></extra>"
-                    ))
+    trace_type = _trace_type(df, graph_type)
+    hover_y = "広告費: %{x:,.0f}円<br>N-CPA: %{y:,.0f}円<extra></extra>"
+    hover_main, hover_ext, ext_names = _brand_strings(df, hover_y)
+
+    # トレースの集め方は build_uu_traces と同じ（ブランド順）
+    brand_traces = [[] for _ in range(len(df))]
+
+    # 対数回帰からN-CPA算出（単調増加部分のみ）
+    if 'log' in _GRAPH_FITS[graph_type]:
+        x_mins, x_maxs = df['データ範囲 min x'].to_numpy(), df['データ範囲 max x'].to_numpy()
+        a_logs, b_logs = df['a_log'].to_numpy(), df['b_log'].to_numpy()
+        for i, color, label, legend_group in _fit_rows(df, 'log', graph_type):
+            x_min, x_max, a_log, b_log = x_mins[i], x_maxs[i], a_logs[i], b_logs[i]
+            main, right = curves[i]['main'], curves[i]['right']
+            traces = brand_traces[i]
+
+            # 表示開始点: N-CPA最小点とデータ範囲の大きい方
+            # N-CPA = x / (a * ln(x) + b) の最小点は微分して0になる点 x = exp(1 - b/a)
+            # （a > 0 ならその点のUUは a * (1 - b/a) + b = a > 0 なので確認は不要）
+            # 指数は exp が桁あふれしないよう打ち切る（打ち切るほど大きければデータ範囲外）
+            if a_log > 0:
+                x_start = max(math.exp(min(1 - b_log / a_log, 700.0)), x_min)
+            else:
+                x_start = x_min
+
+            # データ範囲内（実線）- 単調増加部分のみ
+            if x_start < x_max:
+                increasing = main['x_ncpa_log'] >= x_start
+                x_ncpa, ncpa = main['x_ncpa_log'][increasing], main['ncpa_log'][increasing]
+                # 最小点がデータ範囲内なら、その点自体を先頭に加える
+                # （共有グリッドの点だけだと開始位置がずれ、x_max に近いと線にならない。最小点のUUは a）
+                if x_start > x_min:
+                    x_ncpa = np.concatenate((np.array([x_start], dtype=x_ncpa.dtype), x_ncpa))
+                    ncpa = np.concatenate((np.array([x_start / a_log], dtype=ncpa.dtype), ncpa))
+
+                _emit_curve(traces, x_ncpa, ncpa, color,
+                            label, legend_group, hover_main[i], showlegend=False, trace_type=trace_type)
+
+                # 外挿範囲（点線）- 右側のみ（単調増加方向）
+                if right is not None:
+                    _emit_curve(traces, right['x_ncpa_log'], right['ncpa_log'], color,
+                                ext_names[i], legend_group, hover_ext[i], extrapolated=True, trace_type=trace_type)
+
+    # 線形回帰からN-CPA算出
+    # 線形の場合: N-CPA = x / (ax + b) は x→∞ で 1/a に収束（単調減少）
+    # 実務的には対数回帰のみが意味を持つが、参考として表示
+    if 'lin' in _GRAPH_FITS[graph_type]:
+        line_style = 'dot' if graph_type == "両方表示" else None
+        for i, color, label, legend_group in _fit_rows(df, 'lin', graph_type):
+            main, right = curves[i]['main'], curves[i]['right']
+            traces = brand_traces[i]
+
+            _emit_curve(traces, main['x_ncpa_lin'], main['ncpa_lin'], color,
+                        label, legend_group, hover_main[i], line_style=line_style, showlegend=False,
+                        trace_type=trace_type)
+
+            # 外挿範囲（点線）- 右側のみ
+            if right is not None:
+                _emit_curve(traces, right['x_ncpa_lin'], right['ncpa_lin'], color,
+                            ext_names[i], legend_group, hover_ext[i], extrapolated=True, trace_type=trace_type)
+
+    return [trace for traces in brand_traces for trace in traces]
+
+
+def generate_figure(uu_traces, ncpa_traces, title):
+    """新規UU（上段）とN-CPA（下段）をX軸共有の1つのFigureにまとめる"""
+    fig = make_subplots(rows=2, cols=1, shared_xaxes=True, vertical_spacing=0.08, subplot_titles=_SUBPLOT_TITLES)
+    fig.add_traces(uu_traces, rows=1, cols=1)
+    fig.add_traces(ncpa_traces, rows=2, cols=1)
 
     # レイアウト設定
-    fig.update_layout(
-        title=dict(text=title, font=dict(size=20)),
-        xaxis_title="月間SA広告費 (円)",
-        yaxis_title="N-CPA (円/UU)",
-        hovermode='closest',
-        legend=dict(
-            yanchor="top",
-            y=0.99,
-            xanchor="left",
-            x=1.02,
-            font=dict(size=10)
-        ),
-        margin=dict(r=250),
-        template='plotly_white'
-    )
+    fig.update_layout(**_LAYOUT, title=dict(text=title, font=dict(size=20)))
+    fig.update_xaxes(**_XAXIS_OPTS)
+    fig.update_xaxes(title_text=_XAXIS_TITLE, row=2, col=1)
+    fig.update_yaxes(**_UU_YAXIS_OPTS, row=1, col=1)
+    fig.update_yaxes(**_NCPA_YAXIS_OPTS, row=2, col=1)
 
-    # X軸のフォーマット
-    fig.update_xaxes(
-        tickformat=",",
-        gridcolor='lightgray',
-        gridwidth=0.5,
-        rangemode='tozero'
-    )
-    fig.update_yaxes(
-        tickformat=",",
-        gridcolor='lightgray',
-        gridwidth=0.5,
-        rangemode='tozero'
+    return fig
+
+
+class MissingColumnsError(Exception):
+    """入力データに必要なカラムが不足している"""
+
+    def __init__(self, missing_cols):
+        super().__init__(f"必要なカラムが見つかりません: {missing_cols}")
+        self.missing_cols = missing_cols
+
+
+@st.cache_resource(max_entries=16, show_spinner=False)
+def _build_figure(data_input: str, graph_type: str, show_extrap: bool, title: str, ratio: float):
+    """
+    入力テキストと設定からグラフを生成（同じ入力ならキャッシュ済みのFigureをそのまま返す）
+    返したFigureはキャッシュと共有されるので変更しないこと
+    """
+    # データをパース（不足カラムは下で確認するので usecols は存在するものだけ選ぶ関数で指定）
+    df = pd.read_csv(
+        io.StringIO(data_input),
+        sep='\t',
+        usecols=lambda col: col in _USECOLS,
+        dtype=_DTYPES,
+        engine='c'
     )
 
-    return fig
+    # 必要なカラムの確認
+    required_cols = ['出品者カテゴリー', 'データ範囲 min x', 'データ範囲 max x']
+    missing_cols = [col for col in required_cols if col not in df.columns]
+    if missing_cols:
+        raise MissingColumnsError(missing_cols)
+
+    # 数値カラムを数値化（桁区切り「195,023」は外し、数値として読めないセルはNaN）
+    for col in _NUMERIC_COLS:
+        df[col] = pd.to_numeric(df[col].str.replace(',', '', regex=False), errors='coerce').astype('float64')
+
+    # データ範囲が数値でない行は曲線を描けないので除外（下流では行番号を添字に使うので振り直す）
+    invalid = df[['データ範囲 min x', 'データ範囲 max x']].isna().any(axis=1)
+    skipped = tuple(df.loc[invalid, '出品者カテゴリー'].astype(str))
+    df = df[~invalid].reset_index(drop=True)
+
+    # 回帰式を列ごとに一括パース（パースできない行はNaN）
+    df[['a_log', 'b_log']] = df['広告費と広告新規UUの対数回帰式'].str.extract(_LOG_RE).astype(float)
+    df[['a_lin', 'b_lin']] = df['広告費と広告新規UUの線形回帰式'].str.extract(_LIN_RE).astype(float)
+
+    # 曲線データはブランドごとに1回だけ計算し、両グラフで共有
+    curves = build_brand_curves(df, show_extrap, ratio)
+
+    # 上下段のトレースは互いに独立なので並行して生成（st.* は呼ばないのでスレッドから実行可）
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        future_uu = executor.submit(build_uu_traces, df, curves, graph_type)
+        future_ncpa = executor.submit(build_ncpa_traces, df, curves, graph_type)
+        uu_traces, ncpa_traces = future_uu.result(), future_ncpa.result()
+    return generate_figure(uu_traces, ncpa_traces, title), len(df), skipped
 
 
 # グラフ生成ボタン
 if st.button("📊 グラフ生成", type="primary"):
     try:
-        # データをパース
-        df = pd.read_csv(io.StringIO(data_input), sep='\t')
-
-        # 必要なカラムの確認
-        required_cols = ['出品者カテゴリー', 'データ範囲 min x', 'データ範囲 max x']
-        missing_cols = [col for col in required_cols if col not in df.columns]
-
-        if missing_cols:
-            st.error(f"必要なカラムが見つかりません: {missing_cols}")
-        else:
-            # 数値変換
-            df['データ範囲 min x'] = pd.to_numeric(df['データ範囲 min x'], errors='coerce')
-            df['データ範囲 max x'] = pd.to_numeric(df['データ範囲 max x'], errors='coerce')
-            df['決定係数(対数)'] = pd.to_numeric(df['決定係数(対数)'], errors='coerce')
-            df['決定係数(線形)'] = pd.to_numeric(df['決定係数(線形)'], errors='coerce')
-
-            # グラフ生成してセッション状態に保存
-            st.session_state.fig_uu = generate_graph(df, graph_type, show_extrapolation, graph_title, extrapolation_ratio)
-            st.session_state.fig_ncpa = generate_ncpa_graph(df, graph_type, show_extrapolation, f"{graph_title} - N-CPA", extrapolation_ratio)
-            st.session_state.graph_generated = True
-            st.session_state.brand_count = len(df)
-
+        # グラフ生成し、成功したら引数をセッション状態に保存
+        graph_args = (data_input, graph_type, show_extrapolation, graph_title, extrapolation_ratio)
+        _build_figure(*graph_args)
+        st.session_state.graph_args = graph_args
+        st.session_state.html = {}
+        st.session_state.json = None
+
+    except MissingColumnsError as e:
+        st.error(str(e))
     except Exception as e:
         st.error(f"エラーが発生しました: {e}")
         st.info("データの形式を確認してください。タブ区切りでヘッダー行を含める必要があります。")
 
 # グラフが生成されていれば表示（ダウンロード後も維持される）
-if st.session_state.graph_generated and st.session_state.fig_uu is not None:
-    st.success(f"✅ {st.session_state.brand_count}ブランドのデータを読み込みました")
+if st.session_state.graph_args is not None:
+    fig, brand_count, skipped = _build_figure(*st.session_state.graph_args)
+    st.success(f"✅ {brand_count}ブランドのデータを読み込みました")
+    if skipped:
+        st.warning(f"⚠️ データ範囲が空欄または数値でないため除外しました: {', '.join(skipped)}")
 
     # グラフ表示
     st.subheader("2️⃣ グラフプレビュー")
-
-    tab1, tab2 = st.tabs(["📈 新規UUグラフ", "💰 N-CPAグラフ"])
-
-    with tab1:
-        st.plotly_chart(st.session_state.fig_uu, use_container_width=True)
-
-    with tab2:
-        st.markdown("**N-CPA = 広告費 ÷ 新規UU**")
-        st.plotly_chart(st.session_state.fig_ncpa, use_container_width=True)
+    st.plotly_chart(fig, use_container_width=True)
 
     # HTMLダウンロード
     st.subheader("3️⃣ ダウンロード")
 
-    col_dl1, col_dl2 = st.columns(2)
-
-    with col_dl1:
-        html_uu = st.session_state.fig_uu.to_html(include_plotlyjs=True, full_html=True)
-        st.download_button(
-            label="📥 新規UUグラフ (HTML)",
-            data=html_uu,
-            file_name="brand_regression_uu.html",
-            mime="text/html"
-        )
-
-    with col_dl2:
-        html_ncpa = st.session_state.fig_ncpa.to_html(include_plotlyjs=True, full_html=True)
-        st.download_button(
-            label="📥 N-CPAグラフ (HTML)",
-            data=html_ncpa,
-            file_name="brand_regression_ncpa.html",
-            mime="text/html"
-        )
+    # 通常はplotly.jsをCDNから読み込む（埋め込むと1ファイル約3.5MBになる）
+    offline_html = st.checkbox(
+        "plotly.jsをHTMLに埋め込む（オフライン閲覧用）",
+        value=False,
+        help="社内ネットワーク等でCDNにアクセスできない場合にチェックしてください"
+    )
+    include_plotlyjs = True if offline_html else 'cdn'
+
+    if include_plotlyjs not in st.session_state.html:
+        st.session_state.html[include_plotlyjs] = fig.to_html(include_plotlyjs=include_plotlyjs, full_html=True)
+    st.download_button(
+        label="📥 グラフ (HTML)",
+        data=st.session_state.html[include_plotlyjs],
+        file_name="brand_regression.html",
+        mime="text/html"
+    )
 
     st.info("💡 ダウンロードしたHTMLファイルはブラウザで開くとインタラクティブに操作できます")
 
+    # 軽量ダウンロード（グラフJSON + ビューア）
+    with st.expander("🪶 軽量ダウンロード（JSON）", expanded=False):
+        st.caption("グラフデータのみのJSONです。ビューアHTMLをブラウザで開き、JSONファイルを選択すると表示できます（ビューアは初回のみ）")
+
+        col_json1, col_json2 = st.columns(2)
+        with col_json1:
+            # expanderの中身は閉じていても実行されるので、JSONはボタンを押したときだけ作る
+            if st.session_state.json is None and st.button("🛠️ グラフ (JSON) を作成"):
+                st.session_state.json = fig.to_json()
+            if st.session_state.json is not None:
+                st.download_button(
+                    label="📥 グラフ (JSON)",
+                    data=st.session_state.json,
+                    file_name="brand_regression.json",
+                    mime="application/json"
+                )
+        with col_json2:
+            st.download_button(
+                label="📥 ビューア (HTML)",
+                data=_JSON_VIEWER_HTML,
+                file_name="viewer.html",
+                mime="text/html"
+            )
+
 # 使い方
 with st.expander("📖 使い方"):
     st.markdown("""